@@ -1,15 +1,37 @@
 import os
+import ast
 import json
+import hashlib
 import time
+import argparse
 import pandas as pd
-import sys
+from concurrent.futures import ProcessPoolExecutor
 from dotenv import load_dotenv
 from google import genai
-from google.genai.errors import ServerError  # type: ignore
+from google.genai import types
+from google.genai.errors import APIError, ServerError  # type: ignore
+from prompt_builder import encode_rows, report_savings
+from tracing import trace_run, span
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:  # Parquet 輸出為選用功能
+    pa = None
+    pq = None
 
 # 載入 .env 中的 GEMINI_API_KEY
 load_dotenv()
 
+OUTPUT_CSV = "knowledge_learning_output.csv"
+OUTPUT_PARQUET = "knowledge_learning_output.parquet"
+# 模型分級：依序由便宜、低延遲的模型開始，驗證失敗的知識名詞才升級到下一級
+MODEL_TIERS = ["gemini-2.0-flash-lite", "gemini-2.0-flash"]
+# 增量模式以 (user_id, knowledge_term) 複合鍵值對應前次輸出的資料列
+KEY_COLUMNS = ["user_id", "knowledge_term"]
+# 分片輸出時記錄原始列位置的欄位，合併後移除
+ROW_ORDER_COL = "_row_order"
+
 # HW2
 ITEMS = [
     "定義與解釋",
@@ -44,93 +66,527 @@ def parse_response(response_text):
         print(f"解析 JSON 失敗：{e}")
         print("原始回傳內容：", response_text)
         return {item: "" if item != "觀念題目" else [] for item in ITEMS}
-#HW2
-def process_batch_dialogue(client, dialogues: list, delimiter="-----"):
+
+def normalize_result(result: dict) -> dict:
     """
-    將多筆知識名詞合併成一個批次請求。
-    提示中要求模型對每筆知識名詞進行分析並提供完整的學習建議。
+    統一單筆結果的型別：文字項目轉為字串，觀念題目轉為字串清單。
+    模型偶爾會回傳巢狀物件或單一字串，寫入欄位前先整理。
+    """
+    normalized = {}
+    for item in ITEMS:
+        value = result.get(item, "" if item != "觀念題目" else [])
+        if item == "觀念題目":
+            if isinstance(value, str):
+                value = [value] if value.strip() else []
+            elif not isinstance(value, (list, tuple)):
+                value = [] if value is None else [value]
+            normalized[item] = [str(q) for q in value]
+        else:
+            normalized[item] = value if isinstance(value, str) else json.dumps(value, ensure_ascii=False)
+    return normalized
+
+def build_arrow_schema(df: pd.DataFrame):
+    """
+    依批次 DataFrame 建立 Parquet schema。
+    觀念題目固定為 list<string>，避免第一批全為空清單時被推斷成 list<null>；
+    knowledge_term 以字典型別儲存，重複的名詞只存一次。
     """
-    prompt = (
+    schema = pa.Schema.from_pandas(df, preserve_index=False)
+    for col in ["knowledge_term"] + ITEMS:
+        if col not in df.columns:
+            continue
+        if col == "觀念題目":
+            col_type = pa.list_(pa.string())
+        elif col == "knowledge_term":
+            col_type = pa.dictionary(pa.int32(), pa.string())
+        else:
+            col_type = pa.string()
+        schema = schema.set(schema.get_field_index(col), pa.field(col, col_type))
+    return schema
+
+class ResultWriter:
+    """
+    批次結果輸出器，支援 CSV（預設）與 Parquet 兩種格式。
+    CSV 以附加模式逐批寫入；Parquet 以同一個 ParquetWriter 逐批寫入 row group，
+    knowledge_term 存為字典型別欄位。
+    """
+
+    def __init__(self, output_path: str, fmt: str = "csv"):
+        if fmt == "parquet" and pa is None:
+            raise ValueError("輸出 Parquet 需要安裝 pyarrow")
+        self.output_path = output_path
+        self.fmt = fmt
+        self._parquet_writer = None
+        self._header_written = False
+
+    def write(self, batch_df: pd.DataFrame):
+        with span("write_output", format=self.fmt, rows=len(batch_df)):
+            if self.fmt == "parquet":
+                if self._parquet_writer is None:
+                    schema = build_arrow_schema(batch_df)
+                    self._parquet_writer = pq.ParquetWriter(self.output_path, schema, compression="zstd")
+                table = pa.Table.from_pandas(batch_df, schema=self._parquet_writer.schema, preserve_index=False)
+                self._parquet_writer.write_table(table)
+            else:
+                batch_df.to_csv(
+                    self.output_path,
+                    mode="a" if self._header_written else "w",
+                    index=False,
+                    header=not self._header_written,
+                    encoding="utf-8-sig"
+                )
+            self._header_written = True
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._parquet_writer.close()
+            self._parquet_writer = None
+
+def load_output(path: str) -> pd.DataFrame:
+    """
+    讀取先前產生的結果檔。
+    Parquet 以記憶體映射讀取；CSV 則把觀念題目字串還原成清單。
+    """
+    with span("load_output", path=path):
+        if path.endswith(".parquet"):
+            if pq is None:
+                raise ValueError("讀取 Parquet 需要安裝 pyarrow")
+            df = pq.read_table(path, memory_map=True).to_pandas()
+            if "knowledge_term" in df.columns:
+                # 字典欄位讀回為 Categorical，轉回一般字串以便比對與合併
+                df["knowledge_term"] = df["knowledge_term"].astype(object)
+            if "觀念題目" in df.columns:
+                df["觀念題目"] = df["觀念題目"].map(lambda q: list(q) if q is not None else [])
+            return df
+        df = pd.read_csv(path, encoding="utf-8-sig")
+        if "觀念題目" in df.columns:
+            df["觀念題目"] = df["觀念題目"].map(
+                lambda q: ast.literal_eval(q) if isinstance(q, str) and q.startswith("[") else []
+            )
+        for item in ITEMS:
+            if item in df.columns and item != "觀念題目":
+                df[item] = df[item].fillna("")
+        return df
+
+DELIMITER = "-----"
+
+# 靜態指令放在系統指令中，每次請求相同，可被模型端的前綴快取重用
+ANALYSIS_INSTRUCTIONS = (
+    "請根據知識名詞資料進行分析，並提供完整的學習建議。請特別注意以下要求：\n"
+    "  1. 對該知識名詞提供清晰的定義與解釋；\n"
+    "  2. 延伸建議：根據該知識名詞，推薦可以進一步學習的相關知識或領域；\n"
+    "  3. 實際應用：說明該知識如何應用在現實生活中，並提供具體範例；\n"
+    "  4. 搜尋外部網站，找出與該知識名詞相關的最新資訊或學習資源，並將搜尋結果整合進回覆中；\n"
+    "  5. 最後請生成 3-5 個簡單的基本觀念題目（選擇題或問答題），以確認使用者是否理解該知識。\n"
+    "請依編號順序對每筆知識名詞產生 JSON 格式回覆，並在各筆結果間用下列分隔線隔開：\n"
+    f"{DELIMITER}\n"
+    "例如：\n"
+    "```json\n"
+    "{\n  \"定義與解釋\": \"...\",\n  \"延伸建議\": \"...\",\n  \"實際應用\": \"...\",\n  \"外部資源\": \"...\",\n  \"觀念題目\": [\"題目1\", \"題目2\", \"題目3\"]\n}\n"
+    f"{DELIMITER}\n"
+    "{{...}}\n```"
+)
+SYSTEM_PROMPT = "你會收到一批知識名詞，每行一筆，格式為「編號<Tab>知識名詞」。\n" + ANALYSIS_INSTRUCTIONS
+
+def build_legacy_prompt(dialogues: list, delimiter: str = DELIMITER) -> str:
+    """重建舊版提示（批次資料重複出現兩次），僅用於估算節省的 token 數"""
+    header = (
         f"目前正在處理 {len(dialogues)} 筆知識名詞資料。\n"
         f"以下為該批次知識名詞資料:\n{dialogues}\n\n"
-        "請根據以上知識名詞資料進行分析，並提供完整的學習建議。請特別注意以下要求：\n"
-        "  1. 對該知識名詞提供清晰的定義與解釋；\n"
-        "  2. 延伸建議：根據該知識名詞，推薦可以進一步學習的相關知識或領域；\n"
-        "  3. 實際應用：說明該知識如何應用在現實生活中，並提供具體範例；\n"
-        "  4. 搜尋外部網站，找出與該知識名詞相關的最新資訊或學習資源，並將搜尋結果整合進回覆中；\n"
-        "  5. 最後請生成 3-5 個簡單的基本觀念題目（選擇題或問答題），以確認使用者是否理解該知識。\n"
-        "請對每筆知識名詞產生 JSON 格式回覆，並在各筆結果間用下列分隔線隔開：\n"
-        f"{delimiter}\n"
-        "例如：\n"
-        "```json\n"
-        "{\n  \"定義與解釋\": \"...\",\n  \"延伸建議\": \"...\",\n  \"實際應用\": \"...\",\n  \"外部資源\": \"...\",\n  \"觀念題目\": [\"題目1\", \"題目2\", \"題目3\"]\n}\n"
-        f"{delimiter}\n"
-        "{{...}}\n```"
     )
-    batch_text = f"\n{delimiter}\n".join(dialogues)
-    content = prompt + "\n\n" + batch_text
+    return header + ANALYSIS_INSTRUCTIONS + "\n\n" + f"\n{delimiter}\n".join(dialogues)
+
+def build_batch_prompt(dialogues: list) -> str:
+    """將批次知識名詞編成精簡的「編號<Tab>知識名詞」表格，只送一次"""
+    rows = [{"編號": i + 1, "知識名詞": d} for i, d in enumerate(dialogues)]
+    return f"共 {len(dialogues)} 筆知識名詞：\n" + encode_rows(rows, ["編號", "知識名詞"])
+
+#HW2
+def process_batch_dialogue(client, dialogues: list, delimiter=DELIMITER, model="gemini-2.0-flash"):
+    """
+    將多筆知識名詞合併成一個批次請求。
+    固定的分析指令放在系統指令，批次資料只以精簡表格送出一次。
+    """
+    with span("build_prompt", rows=len(dialogues)):
+        content = build_batch_prompt(dialogues)
+        report_savings("DRai", build_legacy_prompt(dialogues, delimiter), SYSTEM_PROMPT, content)
 
     try:
-        response = client.models.generate_content(
-            model="gemini-2.0-flash",
-            contents=content
-        )
+        with span("generate_content", model=model, rows=len(dialogues)):
+            response = client.models.generate_content(
+                model=model,
+                contents=content,
+                config=types.GenerateContentConfig(system_instruction=SYSTEM_PROMPT)
+            )
     except ServerError as e:
         print(f"API 呼叫失敗：{e}")
         return [{item: "" if item != "觀念題目" else [] for item in ITEMS} for _ in dialogues]
     
+    usage = getattr(response, "usage_metadata", None)
+    if usage is not None:
+        print(f"實際輸入 token：{usage.prompt_token_count}（快取命中 {usage.cached_content_token_count or 0}）")
     print("批次 API 回傳內容：", response.text)
-    parts = response.text.split(delimiter)
-    results = []
-    for part in parts:
-        part = part.strip()
-        if part:
-            results.append(parse_response(part))
+    with span("parse_response", rows=len(dialogues)):
+        parts = response.text.split(delimiter)
+        results = []
+        for part in parts:
+            part = part.strip()
+            if part:
+                results.append(parse_response(part))
     if len(results) > len(dialogues):
         results = results[:len(dialogues)]
     elif len(results) < len(dialogues):
         results.extend([{item: "" if item != "觀念題目" else [] for item in ITEMS}] * (len(dialogues) - len(results)))
     return results
 
-def main():
-    if len(sys.argv) < 2:
-        print("Usage: python DRai.py <path_to_csv>")
-        sys.exit(1)
-    
-    input_csv = sys.argv[1]
-    output_csv = "knowledge_learning_output.csv"  # 修改輸出檔名以反映內容
-    if os.path.exists(output_csv):
-        os.remove(output_csv)
-    
-    df = pd.read_csv(input_csv)
+def validate_result(result: dict) -> bool:
+    """
+    檢查單筆結果品質：所有文字項目皆非空白，且觀念題目為 3-5 題。
+    result 需先經過 normalize_result 整理。
+    """
+    for item in ITEMS:
+        if item == "觀念題目":
+            if not 3 <= len(result[item]) <= 5:
+                return False
+        elif not result[item].strip():
+            return False
+    return True
+
+def route_batch(client, dialogues: list, models: list = None) -> list:
+    """
+    模型分級路由：整批先送給第一級（最便宜）模型，
+    驗證未通過的知識名詞才送往下一級模型重新產生，直到通過或用完所有等級。
+    某一級模型呼叫失敗（例如模型不存在或額度用盡）時，該級負責的知識名詞直接升級；
+    所有等級都失敗時才拋出最後一個錯誤。
+    """
+    models = models or MODEL_TIERS
+    results = [normalize_result({}) for _ in dialogues]
+    failing = list(range(len(dialogues)))
+    last_error = None
+    answered = False
+    for tier, model in enumerate(models):
+        if not failing:
+            break
+        if tier > 0:
+            print(f"{len(failing)} 筆結果未通過驗證，升級至 {model} 重新處理")
+        try:
+            retried = process_batch_dialogue(client, [dialogues[i] for i in failing], model=model)
+        except APIError as e:
+            last_error = e
+            print(f"{model} 呼叫失敗：{e}")
+            continue
+        answered = True
+        still_failing = []
+        for i, res in zip(failing, retried):
+            # 較強模型的結果即使未通過驗證也採用，並留待下一級處理
+            results[i] = normalize_result(res)
+            if not validate_result(results[i]):
+                still_failing.append(i)
+        failing = still_failing
+    if not answered:
+        raise last_error
+    if failing:
+        print(f"{len(failing)} 筆結果在所有模型等級皆未通過驗證")
+    return results
+
+def enrich_batches(client, df: pd.DataFrame, batch_size: int = 10, dialogue_col: str = "knowledge_term", models: list = None):
+    """
+    逐批呼叫模型處理 df，每批產生 (已處理筆數, 加上學習建議欄位的批次 DataFrame)。
+    批次 DataFrame 保留原本的 index，方便增量模式合併回完整結果。
+    """
+    total = len(df)
+    for start_idx in range(0, total, batch_size):
+        end_idx = min(start_idx + batch_size, total)
+        batch = df.iloc[start_idx:end_idx]
+        dialogues = batch[dialogue_col].tolist()
+        dialogues = [str(d).strip() for d in dialogues]
+        batch_results = route_batch(client, dialogues, models)
+        with span("assemble_batch", rows=len(batch)):
+            batch_df = batch.copy()
+            for item in ITEMS:
+                batch_df[item] = [res[item] for res in batch_results]
+        yield end_idx, batch_df
+        time.sleep(1)
+
+def row_hash(row, columns: list) -> str:
+    """以輸入欄位的內容計算單筆資料的雜湊值，用來判斷該筆是否有變動"""
+    payload = json.dumps([str(row[c]) for c in columns], ensure_ascii=False)
+    return hashlib.sha1(payload.encode("utf-8")).hexdigest()
+
+def key_columns(df: pd.DataFrame) -> list:
+    """找出 user_id 與 knowledge_term 欄位（不分大小寫，例如 User_id），作為資料列的複合鍵值"""
+    columns = []
+    for name in KEY_COLUMNS:
+        columns.extend(c for c in df.columns if c.lower() == name)
+    return columns
+
+def row_key(row, columns: list) -> tuple:
+    return tuple(str(row[c]).strip() for c in columns)
+
+def diff_against_previous(df: pd.DataFrame, previous: pd.DataFrame):
+    """
+    比對本次輸入與前次輸出。
+    以 (user_id, knowledge_term) 複合鍵值對應資料列（缺少的欄位略過），
+    以輸入欄位的雜湊判斷內容是否變動；未變動但前次結果未通過 validate_result 的資料也重新處理。
+    回傳 (需重新處理的布林清單, 以鍵值對應前次結果列的字典, 使用的鍵值欄位, 統計字典)。
+    """
+    key_cols = key_columns(df)
+    input_cols = [c for c in df.columns if c not in ITEMS]
+    if not key_cols or any(c not in previous.columns for c in input_cols):
+        # 缺少鍵值或輸入欄位已改變，前次結果無法對應，全部重新處理
+        stats = {"added": 0, "modified": len(df), "unchanged": 0, "invalid": 0, "deleted": len(previous)}
+        return [True] * len(df), {}, key_cols, stats
+
+    previous_rows = {row_key(row, key_cols): row for _, row in previous.iterrows()}
+    previous_hash = {key: row_hash(row, input_cols) for key, row in previous_rows.items()}
+
+    pending = []
+    keys = set()
+    stats = {"added": 0, "modified": 0, "unchanged": 0, "invalid": 0, "deleted": 0}
+    for _, row in df.iterrows():
+        key = row_key(row, key_cols)
+        keys.add(key)
+        if key not in previous_hash:
+            stats["added"] += 1
+            pending.append(True)
+        elif previous_hash[key] != row_hash(row, input_cols):
+            stats["modified"] += 1
+            pending.append(True)
+        elif not validate_result(normalize_result(previous_rows[key].to_dict())):
+            # 前次結果不完整（例如模型失敗留下的空白結果），即使輸入未變動也重新處理
+            stats["invalid"] += 1
+            pending.append(True)
+        else:
+            stats["unchanged"] += 1
+            pending.append(False)
+    stats["deleted"] = len(set(previous_hash) - keys)
+    return pending, previous_rows, key_cols, stats
+
+def run_incremental(client, df: pd.DataFrame, output_path: str, fmt: str, models: list = None):
+    """
+    增量模式：只把新增、內容變動或前次結果不完整的資料送進模型，其餘沿用前次結果，
+    前次有而本次輸入已刪除的資料會被移除。合併後依輸入順序重寫輸出檔。
+    """
+    previous = load_output(output_path)
+    with span("diff_against_previous", rows=len(df)):
+        pending, previous_rows, key_cols, stats = diff_against_previous(df, previous)
+    print(
+        f"增量比對：新增 {stats['added']} 筆、變動 {stats['modified']} 筆、"
+        f"前次結果未通過驗證 {stats['invalid']} 筆、未變動 {stats['unchanged']} 筆、"
+        f"刪除 {stats['deleted']} 筆"
+    )
+
+    pending_df = df[pending]
+    new_results = {}
+    for end_idx, batch_df in enrich_batches(client, pending_df, models=models):
+        for idx, row in batch_df.iterrows():
+            new_results[idx] = row
+        print(f"已處理 {end_idx} 筆 / {len(pending_df)}（僅變動資料）")
+
+    with span("merge_results", rows=len(df)):
+        merged = df.copy()
+        keys = [row_key(row, key_cols) for _, row in df.iterrows()]
+        for item in ITEMS:
+            merged[item] = [
+                new_results[idx][item] if idx in new_results else previous_rows[key][item]
+                for idx, key in zip(df.index, keys)
+            ]
+
+    # 先寫入暫存檔再取代，避免中途失敗時弄壞前次結果
+    tmp_path = output_path + ".tmp"
+    writer = ResultWriter(tmp_path, fmt)
+    try:
+        writer.write(merged)
+    finally:
+        writer.close()
+    os.replace(tmp_path, output_path)
+
+def create_client():
     gemini_api_key = os.environ.get("GEMINI_API_KEY")
     if not gemini_api_key:
         raise ValueError("請設定環境變數 GEMINI_API_KEY")
-    client = genai.Client(api_key=gemini_api_key)
+    return genai.Client(api_key=gemini_api_key)
+
+def shard_path(output_path: str, shard_index: int, num_shards: int) -> str:
+    """分片輸出檔名，例如 knowledge_learning_output.shard0of4.csv"""
+    root, ext = os.path.splitext(output_path)
+    return f"{root}.shard{shard_index}of{num_shards}{ext}"
+
+def select_shard(df: pd.DataFrame, shard_index: int, num_shards: int, shard_by: str = "range") -> pd.DataFrame:
+    """
+    取出第 shard_index 個分片，並加上原始列位置欄位供合併時排序。
+    range：依列範圍平均切分；hash：依 user_id（不分大小寫，缺少時用 knowledge_term）的穩定雜湊分配。
+    """
+    df = df.assign(**{ROW_ORDER_COL: range(len(df))})
+    if shard_by == "hash":
+        key_cols = key_columns(df)
+        key_col = key_cols[0] if key_cols else "knowledge_term"
+        # 不使用內建 hash()，其結果在不同行程間不一致
+        mask = [
+            int(hashlib.sha1(str(key).encode("utf-8")).hexdigest(), 16) % num_shards == shard_index
+            for key in df[key_col]
+        ]
+        return df[mask]
+    start = len(df) * shard_index // num_shards
+    end = len(df) * (shard_index + 1) // num_shards
+    return df.iloc[start:end]
+
+def run_shard(input_csv: str, shard_index: int, num_shards: int, shard_by: str, fmt: str,
+              models: list = None, trace: bool = None) -> str:
+    """
+    處理單一分片並寫入該分片自己的輸出檔，可在子行程或其他主機上執行。
+    每個分片各自建立 API client 與追蹤檔，回傳分片輸出檔路徑。
+    """
+    with trace_run(f"DRai_shard{shard_index}of{num_shards}", enabled=trace):
+        return _run_shard(input_csv, shard_index, num_shards, shard_by, fmt, models)
+
+def _run_shard(input_csv: str, shard_index: int, num_shards: int, shard_by: str, fmt: str, models: list = None) -> str:
+    output_path = shard_path(OUTPUT_PARQUET if fmt == "parquet" else OUTPUT_CSV, shard_index, num_shards)
+    if os.path.exists(output_path):
+        os.remove(output_path)
+    with span("read_input", path=input_csv):
+        df = select_shard(pd.read_csv(input_csv), shard_index, num_shards, shard_by)
+    client = create_client()
+
+    writer = ResultWriter(output_path, fmt)
+    total = len(df)
+    try:
+        for end_idx, batch_df in enrich_batches(client, df, models=models):
+            writer.write(batch_df)
+            print(f"[分片 {shard_index}/{num_shards}] 已處理 {end_idx} 筆 / {total}")
+        if total == 0:
+            # 空分片也要留下輸出檔，合併時才能確認所有分片皆已完成
+            writer.write(df.assign(**{item: [] for item in ITEMS}))
+    finally:
+        writer.close()
+    return output_path
+
+def merge_shards(output_path: str, num_shards: int, fmt: str):
+    """
+    將所有分片輸出依原始列位置合併成最終輸出檔，成功後刪除分片檔。
+    """
+    paths = [shard_path(output_path, k, num_shards) for k in range(num_shards)]
+    missing = [p for p in paths if not os.path.exists(p)]
+    if missing:
+        raise ValueError(f"缺少分片輸出，無法合併：{missing}")
+    merged = pd.concat([load_output(p) for p in paths], ignore_index=True)
+    with span("merge_shards", shards=num_shards):
+        merged = merged.sort_values(ROW_ORDER_COL, kind="stable").drop(columns=[ROW_ORDER_COL])
+
+    tmp_path = output_path + ".tmp"
+    writer = ResultWriter(tmp_path, fmt)
+    try:
+        writer.write(merged)
+    finally:
+        writer.close()
+    os.replace(tmp_path, output_path)
+    for p in paths:
+        os.remove(p)
+
+def main():
+    parser = argparse.ArgumentParser(description="知識名詞批次學習建議產生器")
+    parser.add_argument("input_csv", nargs="?", help="含 knowledge_term 欄位的輸入 CSV")
+    parser.add_argument(
+        "--format", choices=["csv", "parquet"], default="csv",
+        help="輸出格式：csv（預設）或 parquet（需 pyarrow，觀念題目存為 list 欄位）"
+    )
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="增量模式：與前次輸出比對，只處理新增或變動的知識名詞並合併回原輸出"
+    )
+    parser.add_argument("--shards", type=int, default=1, help="將輸入切成 N 個分片平行處理")
+    parser.add_argument(
+        "--shard-by", choices=["range", "hash"], default="range",
+        help="分片方式：range 依列範圍、hash 依 user_id 雜湊"
+    )
+    parser.add_argument(
+        "--shard-index", type=int,
+        help="只處理指定的分片（多主機共用檔案系統時使用），全部完成後再以 --merge 合併"
+    )
+    parser.add_argument("--workers", type=int, help="本機平行處理的行程數，預設與分片數相同")
+    parser.add_argument("--merge", action="store_true", help="只合併已完成的分片輸出")
+    parser.add_argument(
+        "--trace", action="store_true",
+        help="輸出各階段耗時與堆疊取樣的 Chrome trace 檔（亦可設定環境變數 PIPELINE_TRACE=1）"
+    )
+    parser.add_argument(
+        "--models", default=",".join(MODEL_TIERS),
+        help="以逗號分隔的模型等級，由便宜到強依序嘗試（預設：%(default)s）"
+    )
+    args = parser.parse_args()
+
+    if args.shards < 1:
+        parser.error("--shards 必須大於等於 1")
+    if args.shard_index is not None and not 0 <= args.shard_index < args.shards:
+        parser.error("--shard-index 必須介於 0 與 shards-1 之間")
+    if args.incremental and args.shards > 1:
+        parser.error("--incremental 不支援與 --shards 同時使用")
+    if args.input_csv is None and not args.merge:
+        parser.error("請指定輸入 CSV 路徑")
+    models = [m.strip() for m in args.models.split(",") if m.strip()]
+    if not models:
+        parser.error("--models 至少需要一個模型")
+
+    with trace_run("DRai", enabled=args.trace or None):
+        run(args, models)
+
+def run(args, models: list):
+    """依命令列參數執行合併、分片、增量或完整處理"""
+    input_csv = args.input_csv
+    # 修改輸出檔名以反映內容
+    output_path = OUTPUT_PARQUET if args.format == "parquet" else OUTPUT_CSV
+
+    if args.merge:
+        merge_shards(output_path, args.shards, args.format)
+        print("分片合併完成。最終結果已寫入：", output_path)
+        return
+
+    if args.shards > 1:
+        if args.shard_index is not None:
+            path = run_shard(input_csv, args.shard_index, args.shards, args.shard_by, args.format, models, args.trace or None)
+            print(f"分片 {args.shard_index} 處理完成：{path}，所有分片完成後請以 --merge 合併")
+            return
+        workers = args.workers or args.shards
+        with ProcessPoolExecutor(max_workers=workers) as executor:
+            futures = [
+                executor.submit(run_shard, input_csv, k, args.shards, args.shard_by, args.format, models, args.trace or None)
+                for k in range(args.shards)
+            ]
+            for future in futures:
+                print("分片處理完成：", future.result())
+        merge_shards(output_path, args.shards, args.format)
+        print("全部處理完成。最終結果已寫入：", output_path)
+        return
+
+    incremental = args.incremental and os.path.exists(output_path)
+    if args.incremental and not incremental:
+        print(f"找不到前次輸出 {output_path}，改為完整處理")
+    if not incremental and os.path.exists(output_path):
+        os.remove(output_path)
+    
+    with span("read_input", path=input_csv):
+        df = pd.read_csv(input_csv)
+    client = create_client()
     
     # 明確指定使用 "knowledge_term" 欄位
     dialogue_col = "knowledge_term"
     print(f"使用欄位作為知識名詞：{dialogue_col}")
+
+    if incremental:
+        run_incremental(client, df, output_path, args.format, models)
+        print("增量處理完成。最終結果已寫入：", output_path)
+        return
     
-    batch_size = 10
+    writer = ResultWriter(output_path, args.format)
     total = len(df)
-    for start_idx in range(0, total, batch_size):
-        end_idx = min(start_idx + batch_size, total)
-        batch = df.iloc[start_idx:end_idx]
-        dialogues = batch[dialogue_col].tolist()
-        dialogues = [str(d).strip() for d in dialogues]
-        batch_results = process_batch_dialogue(client, dialogues)
-        batch_df = batch.copy()
-        for item in ITEMS:
-            batch_df[item] = [res.get(item, "" if item != "觀念題目" else []) for res in batch_results]
-        if start_idx == 0:
-            batch_df.to_csv(output_csv, index=False, encoding="utf-8-sig")
-        else:
-            batch_df.to_csv(output_csv, mode='a', index=False, header=False, encoding="utf-8-sig")
-        print(f"已處理 {end_idx} 筆 / {total}")
-        time.sleep(1)
+    try:
+        for end_idx, batch_df in enrich_batches(client, df, dialogue_col=dialogue_col, models=models):
+            writer.write(batch_df)
+            print(f"已處理 {end_idx} 筆 / {total}")
+    finally:
+        writer.close()
     
-    print("全部處理完成。最終結果已寫入：", output_csv)
+    print("全部處理完成。最終結果已寫入：", output_path)
 
 if __name__ == "__main__":
     main()
@@ -6,6 +6,10 @@ import google.generativeai as genai
 import pdfkit
 from jinja2 import Template
 from playwright.sync_api import sync_playwright
+from report_router import (
+    REPORT_RULES, REPORT_MODEL_TIERS, load_table, route_block_report
+)
+from tracing import trace_run, span
 import random
 import requests  # For simulating file upload
 
@@ -88,8 +92,9 @@ def parse_markdown_table(markdown_text: str) -> pd.DataFrame:
 
 def generate_html(text: str = None, df: pd.DataFrame = None) -> str:
     """生成 HTML 內容"""
-    template = Template(HTML_TEMPLATE)
-    return template.render(table=df, text=text)
+    with span("render_html"):
+        template = Template(HTML_TEMPLATE)
+        return template.render(table=df, text=text)
 
 def generate_pdf(text: str = None, df: pd.DataFrame = None) -> str:
     """生成 PDF 檔案"""
@@ -97,7 +102,8 @@ def generate_pdf(text: str = None, df: pd.DataFrame = None) -> str:
     html_content = generate_html(text, df)
     pdf_filename = f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
     try:
-        pdfkit.from_string(html_content, pdf_filename, configuration=config)
+        with span("pdf_convert"):
+            pdfkit.from_string(html_content, pdf_filename, configuration=config)
         print(f"PDF 生成完成，檔案：{pdf_filename}")
     except Exception as e:
         error_msg = f"PDF 生成失敗：{str(e)}"
@@ -114,15 +120,18 @@ def simulate_file_upload(pdf_path: str) -> str:
 
 def process_csv_and_generate_report(csv_path: str, user_prompt: str) -> tuple:
     """處理 CSV 並生成報表"""
-    model_name = "gemini-1.5-flash"
-    try:
-        model = genai.GenerativeModel(model_name)
-    except Exception as e:
-        raise Exception(f"無法初始化模型 {model_name}：{str(e)}")
+    system_instruction = REPORT_RULES + user_prompt
+    models = []
+    for model_name in REPORT_MODEL_TIERS:
+        try:
+            models.append((model_name, genai.GenerativeModel(model_name, system_instruction=system_instruction)))
+        except Exception as e:
+            raise Exception(f"無法初始化模型 {model_name}：{str(e)}")
 
     print("讀取 CSV 檔案")
     try:
-        df = pd.read_csv(csv_path)
+        with span("load_table", path=csv_path):
+            df = load_table(csv_path)
         print(f"CSV 欄位：{df.columns.tolist()}")
     except Exception as e:
         raise Exception(f"無法讀取 CSV 檔案：{str(e)}")
@@ -133,28 +142,19 @@ def process_csv_and_generate_report(csv_path: str, user_prompt: str) -> tuple:
 
     for i in range(0, total_rows, block_size):
         block = df.iloc[i:i+block_size]
-        block_csv = block.to_csv(index=False)
-        prompt = (
-            f"以下是 CSV 資料第 {i+1} 到 {min(i+block_size, total_rows)} 筆：\n"
-            f"{block_csv}\n\n"
-            f"請根據以下規則進行分析並產出報表（以 Markdown 表格格式輸出）：\n"
-            f"1. 針對每個知識名詞，檢查其定義、延伸建議、實際應用、外部資源和觀念題目是否完整。\n"
-            f"2. 如果任何欄位缺失或不完整，提供補充內容（例如詳細的定義、具體的應用案例等）。\n"
-            f"3. 確保輸出為 Markdown 表格，包含所有原始欄位，並在適當欄位中新增補充內容。\n"
-            f"4. 補充內容應清晰、具體，並與現有資料一致。\n"
-            f"{user_prompt}"
-        )
         print(f"處理區塊 {i//block_size+1}")
         try:
-            response = model.generate_content(prompt)
-            block_response = response.text.strip()
+            block_response = route_block_report(
+                models, block, parse_markdown_table, user_prompt, label=f"HW4 區塊 {i//block_size+1}"
+            )
             cumulative_response += f"區塊 {i//block_size+1}:\n{block_response}\n\n"
         except Exception as e:
             error_msg = f"生成內容失敗（區塊 {i//block_size+1}）：{str(e)}"
             print(error_msg)
             cumulative_response += f"區塊 {i//block_size+1} 錯誤：{error_msg}\n\n"
 
-    df_result = parse_markdown_table(cumulative_response)
+    with span("parse_markdown_table", scope="all"):
+        df_result = parse_markdown_table(cumulative_response)
     pdf_path = generate_pdf(df=df_result) if df_result is not None else generate_pdf(text=cumulative_response)
     return cumulative_response, pdf_path
 
@@ -213,8 +213,9 @@ def post_to_reddit(pdf_path: str, post_title: str, subreddit: str = "test"):
 def main(csv_path: str, user_prompt: str, post_title: str, subreddit: str = "test"):
     """主函數：生成 PDF 並發文到 Reddit"""
     try:
-        # 生成報表和 PDF
-        response_text, pdf_path = process_csv_and_generate_report(csv_path, user_prompt)
+        # 生成報表和 PDF（設定 PIPELINE_TRACE=1 時輸出各階段的追蹤檔）
+        with trace_run("HW4"):
+            response_text, pdf_path = process_csv_and_generate_report(csv_path, user_prompt)
         print(f"報表生成完成：{response_text[:100]}...")
 
         # 發文到 Reddit
@@ -1,4 +1,5 @@
 import os
+import sys
 from datetime import datetime
 import pandas as pd
 from dotenv import load_dotenv
@@ -8,6 +9,13 @@ from jinja2 import Template
 from flask import Flask, request, render_template, send_file, Response
 from werkzeug.utils import secure_filename
 
+# 提示詞與追蹤模組放在專案根目錄，與 DRai.py、HW4.py 共用
+sys.path.append(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+from report_router import (
+    REPORT_RULES, REPORT_MODEL_TIERS, load_table, route_block_report
+)
+from tracing import trace_run, span
+
 # 設定 wkhtmltopdf 路徑
 WKHTMLTOPDF_PATH = "C:/Program Files/wkhtmltopdf/bin/wkhtmltopdf.exe"
 config = pdfkit.configuration(wkhtmltopdf=WKHTMLTOPDF_PATH)
@@ -92,8 +100,9 @@ def generate_html(text: str = None, df: pd.DataFrame = None) -> str:
     """
     使用 jinja2 模板生成 HTML 內容。
     """
-    template = Template(HTML_TEMPLATE)
-    return template.render(table=df, text=text)
+    with span("render_html"):
+        template = Template(HTML_TEMPLATE)
+        return template.render(table=df, text=text)
 
 def generate_pdf(text: str = None, df: pd.DataFrame = None) -> str:
     """
@@ -103,7 +112,8 @@ def generate_pdf(text: str = None, df: pd.DataFrame = None) -> str:
     html_content = generate_html(text, df)
     pdf_filename = f"report_{datetime.now().strftime('%Y%m%d_%H%M%S')}.pdf"
     try:
-        pdfkit.from_string(html_content, pdf_filename, configuration=config)
+        with span("pdf_convert"):
+            pdfkit.from_string(html_content, pdf_filename, configuration=config)
         print(f"PDF 生成完成，檔案：{pdf_filename}")
     except Exception as e:
         error_msg = f"PDF 生成失敗：{str(e)}"
@@ -127,34 +137,35 @@ def process_input(csv_file, user_prompt):
     if csv_file is not None:
         print("讀取 CSV 檔案")
         try:
-            df = pd.read_csv(csv_file)
+            with span("load_table", path=csv_file):
+                df = load_table(csv_file)
             print(f"CSV 欄位：{df.columns.tolist()}")
         except Exception as e:
             error_msg = f"無法讀取 CSV 檔案：{str(e)}"
             print(error_msg)
             return error_msg, None
 
+        system_instruction = REPORT_RULES + user_prompt
+        block_models = []
+        for tier_name in REPORT_MODEL_TIERS:
+            try:
+                block_models.append((tier_name, genai.GenerativeModel(tier_name, system_instruction=system_instruction)))
+            except Exception as e:
+                error_msg = f"無法初始化模型 {tier_name}：{str(e)}"
+                print(error_msg)
+                return error_msg, None
+
         total_rows = df.shape[0]
         block_size = 30
         cumulative_response = ""
         
         for i in range(0, total_rows, block_size):
             block = df.iloc[i:i+block_size]
-            block_csv = block.to_csv(index=False)
-            prompt = (
-                f"以下是 CSV 資料第 {i+1} 到 {min(i+block_size, total_rows)} 筆：\n"
-                f"{block_csv}\n\n"
-                f"請根據以下規則進行分析並產出報表（以 Markdown 表格格式輸出）：\n"
-                f"1. 針對每個知識名詞，檢查其定義、延伸建議、實際應用、外部資源和觀念題目是否完整。\n"
-                f"2. 如果任何欄位缺失或不完整，提供補充內容（例如詳細的定義、具體的應用案例等）。\n"
-                f"3. 確保輸出為 Markdown 表格，包含所有原始欄位，並在適當欄位中新增補充內容。\n"
-                f"4. 補充內容應清晰、具體，並與現有資料一致。\n"
-                f"{user_prompt}"
-            )
             print(f"處理區塊 {i//block_size+1}")
             try:
-                response = model.generate_content(prompt)
-                block_response = response.text.strip()
+                block_response = route_block_report(
+                    block_models, block, parse_markdown_table, user_prompt, label=f"HW5 區塊 {i//block_size+1}"
+                )
                 cumulative_response += f"區塊 {i//block_size+1}:\n{block_response}\n\n"
             except Exception as e:
                 error_msg = f"生成內容失敗（區塊 {i//block_size+1}）：{str(e)}"
@@ -162,7 +173,8 @@ def process_input(csv_file, user_prompt):
                 cumulative_response += f"區塊 {i//block_size+1} 錯誤：{error_msg}\n\n"
         
         # 嘗試解析 Markdown 表格
-        df_result = parse_markdown_table(cumulative_response)
+        with span("parse_markdown_table", scope="all"):
+            df_result = parse_markdown_table(cumulative_response)
         if df_result is not None:
             print("成功解析 Markdown 表格")
             pdf_path = generate_pdf(df=df_result)
@@ -174,7 +186,8 @@ def process_input(csv_file, user_prompt):
     else:
         print("未上傳 CSV，處理純文字輸入")
         try:
-            response = model.generate_content(user_prompt)
+            with span("generate_content", model=model_name):
+                response = model.generate_content(user_prompt)
             response_text = response.text.strip()
         except Exception as e:
             error_msg = f"生成內容失敗：{str(e)}"
@@ -182,7 +195,8 @@ def process_input(csv_file, user_prompt):
             return error_msg, None
         
         # 嘗試解析 Markdown 表格
-        df_result = parse_markdown_table(response_text)
+        with span("parse_markdown_table", scope="all"):
+            df_result = parse_markdown_table(response_text)
         if df_result is not None:
             print("成功解析 Markdown 表格")
             pdf_path = generate_pdf(df=df_result)
@@ -210,10 +224,13 @@ def index():
             filename = secure_filename(csv_file.filename)
             csv_path = os.path.join(app.config['UPLOAD_FOLDER'], filename)
             csv_file.save(csv_path)
-            response_text, pdf_path = process_input(csv_path, user_prompt)
+            # 設定 PIPELINE_TRACE=1 時，每次請求輸出一份各階段的追蹤檔
+            with trace_run("HW5"):
+                response_text, pdf_path = process_input(csv_path, user_prompt)
             os.remove(csv_path)  # 清理上傳的檔案
         else:
-            response_text, pdf_path = process_input(None, user_prompt)
+            with trace_run("HW5"):
+                response_text, pdf_path = process_input(None, user_prompt)
         
         if pdf_path and os.path.exists(pdf_path):
             return render_template('result.html', response_text=response_text, pdf_path=pdf_path)
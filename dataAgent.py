@@ -1,5 +1,8 @@
 import os
+import json
 import asyncio
+import hashlib
+import argparse
 import pandas as pd
 from dotenv import load_dotenv
 import io
@@ -11,23 +14,73 @@ from autogen_agentchat.teams import RoundRobinGroupChat
 from autogen_agentchat.messages import TextMessage
 from autogen_ext.models.openai import OpenAIChatCompletionClient
 from autogen_ext.agents.web_surfer import MultimodalWebSurfer
+from prompt_builder import encode_rows, report_savings
 
 load_dotenv()
-# HW1 Prompt change info
-async def process_chunk(chunk, start_idx, total_records, model_client, termination_condition):
+
+def compute_row_keys(chunk):
     """
-    處理單一批次資料：
-      - 將該批次資料轉成 dict 格式
-      - 組出提示，要求各代理人根據使用者輸入的知識名詞進行分析，
-        並提供完整的學習內容與建議。
-      - 請 MultimodalWebSurfer 代理人利用外部網站搜尋功能，
-        搜尋相關知識名詞的最新資訊與資源，並納入回覆中。
-      - 收集所有回覆訊息並返回。
+    為每筆資料產生「鍵值:內容雜湊」字串，鍵值為 user_id 與 knowledge_term 的組合
+    （欄位名稱不分大小寫，缺少的欄位略過），
+    用於增量模式判斷該筆資料是否新增、變動或已刪除。
     """
-    # 將資料轉成 dict 格式
-    chunk_data = chunk.to_dict(orient='records')
-    prompt = (
-        f"目前正在處理第 {start_idx} 至 {start_idx + len(chunk) - 1} 筆資料（共 {total_records} 筆）。\n"
+    key_cols = [c for name in ("user_id", "knowledge_term") for c in chunk.columns if c.lower() == name]
+    input_cols = list(chunk.columns)
+    keys = []
+    for _, row in chunk.iterrows():
+        key = "|".join(str(row[c]).strip() for c in key_cols)
+        payload = json.dumps([str(row[c]) for c in input_cols], ensure_ascii=False)
+        keys.append(f"{key}:{hashlib.sha1(payload.encode('utf-8')).hexdigest()}")
+    return keys
+
+def select_pending(df, previous_log):
+    """
+    比對本次輸入與前次對話紀錄：
+      - 前次批次的所有資料都仍存在且未變動，才保留該批次的對話紀錄；
+      - 其餘資料（新增、變動，或與刪除／變動資料同批者）需重新處理；
+      - 已刪除資料所屬批次的舊紀錄會被移除；
+      - 保留的紀錄依 row_keys 對應到本次輸入的位置，重新計算 batch_start／batch_end 與 row_positions。
+    回傳 (保留的對話紀錄, 需處理的資料)。
+    """
+    if "row_keys" not in previous_log.columns:
+        return previous_log.iloc[0:0], df
+    current_keys = compute_row_keys(df)
+    current = set(current_keys)
+    batch_keys = previous_log["row_keys"].map(json.loads)
+    kept_mask = batch_keys.map(lambda keys: set(keys) <= current)
+    kept_log = previous_log[kept_mask].copy()
+    covered = set()
+    for keys in batch_keys[kept_mask]:
+        covered.update(keys)
+
+    # 前次輸入中其他資料被刪除或插入後，保留批次的位置會跟著移動
+    positions_of = {}
+    for pos, key in zip(df.index, current_keys):
+        positions_of.setdefault(key, []).append(int(pos))
+    kept_positions = [sorted(p for key in keys for p in positions_of[key]) for keys in batch_keys[kept_mask]]
+    kept_log["row_positions"] = [json.dumps(positions) for positions in kept_positions]
+    kept_log["batch_start"] = [positions[0] for positions in kept_positions]
+    kept_log["batch_end"] = [positions[-1] for positions in kept_positions]
+    pending_mask = [key not in covered for key in current_keys]
+    return kept_log, df[pending_mask]
+
+# 各代理人共用的固定指令，放在 system message 中，每次模型呼叫的前綴相同可被快取
+AGENT_SYSTEM_PROMPT = (
+    "你會收到一批使用者輸入的知識名詞，以 Tab 分隔的表格呈現，第一行為欄位名稱。\n"
+    "請根據資料進行分析，並提供完整的知識學習建議。"
+    "其中請特別注意：\n"
+    "  1. 對該知識名詞提供清晰的定義與解釋；\n"
+    "  2. 延伸建議：根據該知識名詞，推薦可以進一步學習的相關知識或領域；\n"
+    "  3. 實際應用：說明該知識如何應用在現實生活中，並提供具體範例；\n"
+    "  4. 整合 MultimodalWebSurfer 搜尋到的最新資訊或學習資源；\n"
+    "  5. 最後請生成 3-5 個簡單的基本觀念題目（選擇題或問答題），以確認使用者是否理解該知識。\n"
+    "請各代理人協同合作，提供一份完整、易懂且具學習價值的回覆。"
+)
+
+def build_legacy_prompt(chunk_data, start_idx, end_idx, total_records):
+    """重建舊版提示（每批次重送完整指令與 dict 清單），僅用於估算節省的 token 數"""
+    return (
+        f"目前正在處理第 {start_idx} 至 {end_idx} 筆資料（共 {total_records} 筆）。\n"
         f"以下為該批次資料（使用者輸入的知識名詞）:\n{chunk_data}\n\n"
         "請根據以上資料進行分析，並提供完整的知識學習建議。"
         "其中請特別注意：\n"
@@ -39,11 +92,39 @@ async def process_chunk(chunk, start_idx, total_records, model_client, terminati
         "  5. 最後請生成 3-5 個簡單的基本觀念題目（選擇題或問答題），以確認使用者是否理解該知識。\n"
         "請各代理人協同合作，提供一份完整、易懂且具學習價值的回覆。"
     )
+
+# HW1 Prompt change info
+async def process_chunk(chunk, total_records, model_client, termination_condition):
+    """
+    處理單一批次資料：
+      - 將該批次資料編成精簡的 Tab 分隔表格
+      - 固定的分析指令放在代理人的 system message，任務內容只包含該批次資料，
+        並請 MultimodalWebSurfer 代理人利用外部網站搜尋功能，
+        搜尋相關知識名詞的最新資訊與資源。
+      - 收集所有回覆訊息並返回，batch_start／batch_end 與 row_positions
+        皆為資料在原始輸入中的位置（chunk.index）。
+    """
+    # 將資料轉成 dict 格式
+    chunk_data = chunk.to_dict(orient='records')
+    row_keys = json.dumps(compute_row_keys(chunk), ensure_ascii=False)
+    row_positions = [int(i) for i in chunk.index]
+    start_idx, end_idx = row_positions[0], row_positions[-1]
+    prompt = (
+        f"目前正在處理第 {start_idx} 至 {end_idx} 筆資料（共 {total_records} 筆）：\n"
+        f"{encode_rows(chunk_data, list(chunk.columns))}\n"
+        "請 MultimodalWebSurfer 搜尋外部網站，找出與各知識名詞相關的最新資訊或學習資源。"
+    )
+    report_savings(
+        f"dataAgent 第 {start_idx} 批",
+        build_legacy_prompt(chunk_data, start_idx, end_idx, total_records),
+        AGENT_SYSTEM_PROMPT,
+        prompt
+    )
     
     # 為每個批次建立新的 agent 與 team 實例
-    local_data_agent = AssistantAgent("data_agent", model_client)
+    local_data_agent = AssistantAgent("data_agent", model_client, system_message=AGENT_SYSTEM_PROMPT)
     local_web_surfer = MultimodalWebSurfer("web_surfer", model_client)
-    local_assistant = AssistantAgent("assistant", model_client)
+    local_assistant = AssistantAgent("assistant", model_client, system_message=AGENT_SYSTEM_PROMPT)
     local_user_proxy = UserProxyAgent("user_proxy")
     local_team = RoundRobinGroupChat(
         [local_data_agent, local_web_surfer, local_assistant, local_user_proxy],
@@ -57,16 +138,18 @@ async def process_chunk(chunk, start_idx, total_records, model_client, terminati
             print(f"[{event.source}] => {event.content}\n")
             messages.append({
                 "batch_start": start_idx,
-                "batch_end": start_idx + len(chunk) - 1,
+                "batch_end": end_idx,
+                "row_positions": json.dumps(row_positions),
                 "source": event.source,
                 "content": event.content,
                 "type": event.type,
                 "prompt_tokens": event.models_usage.prompt_tokens if event.models_usage else None,
-                "completion_tokens": event.models_usage.completion_tokens if event.models_usage else None
+                "completion_tokens": event.models_usage.completion_tokens if event.models_usage else None,
+                "row_keys": row_keys
             })
     return messages
 
-async def main():
+async def main(incremental=False):
     gemini_api_key = os.environ.get("GEMINI_API_KEY")
     if not gemini_api_key:
         print("請檢查 .env 檔案中的 GEMINI_API_KEY。")
@@ -80,22 +163,32 @@ async def main():
     
     termination_condition = TextMentionTermination("exit")
     # HW1 Data Set change info
-    # 使用 pandas 以 chunksize 方式讀取 CSV 檔案
+    # 使用 pandas 讀取 CSV 檔案後切成批次
     csv_file_path = "user_input_mod.csv"
+    output_file = "all_conversation_log.csv"
     chunk_size = 5  # 調整為 5，因為目前資料只有 20 筆，每批次處理 5 筆
-    chunks = list(pd.read_csv(csv_file_path, chunksize=chunk_size))
-    total_records = sum(chunk.shape[0] for chunk in chunks)
+    df = pd.read_csv(csv_file_path)
+    total_records = len(df)
+
+    # 增量模式：只處理新增或變動的資料，沿用其餘批次的前次對話紀錄
+    kept_log = None
+    if incremental and os.path.exists(output_file):
+        previous_log = pd.read_csv(output_file, encoding="utf-8-sig")
+        kept_log, df = select_pending(df, previous_log)
+        print(f"增量比對：沿用 {len(kept_log)} 則對話紀錄，需處理 {len(df)} 筆資料")
+
+    # 切片保留原始 index，增量模式下仍能對應到輸入中的位置
+    chunks = [df.iloc[i:i + chunk_size] for i in range(0, len(df), chunk_size)]
     
     # 利用 map 與 asyncio.gather 同時處理所有批次（避免使用傳統 for 迴圈）
     tasks = list(map(
-        lambda idx_chunk: process_chunk(
-            idx_chunk[1],
-            idx_chunk[0] * chunk_size,
+        lambda chunk: process_chunk(
+            chunk,
             total_records,
             model_client,
             termination_condition
         ),
-        enumerate(chunks)
+        chunks
     ))
     
     results = await asyncio.gather(*tasks)
@@ -104,9 +197,18 @@ async def main():
     
     # 將對話紀錄整理成 DataFrame 並存成 CSV
     df_log = pd.DataFrame(all_messages)
-    output_file = "all_conversation_log.csv"
+    if kept_log is not None:
+        df_log = pd.concat([kept_log, df_log], ignore_index=True)
+        # 依資料位置排序，同一批次內的訊息維持原本的對話順序
+        df_log = df_log.sort_values("batch_start", kind="stable", ignore_index=True)
     df_log.to_csv(output_file, index=False, encoding="utf-8-sig")
     print(f"已將所有對話紀錄輸出為 {output_file}")
 
 if __name__ == '__main__':
-    asyncio.run(main())
+    parser = argparse.ArgumentParser(description="多代理人知識學習建議產生器")
+    parser.add_argument(
+        "--incremental", action="store_true",
+        help="增量模式：與前次對話紀錄比對，只處理新增或變動的知識名詞"
+    )
+    args = parser.parse_args()
+    asyncio.run(main(incremental=args.incremental))
@@ -0,0 +1,53 @@
+import os
+import re
+
+# 前綴需達到模型的快取下限才可能命中快取（Gemini 1.5／2.0 的 context cache 下限為 32,768 tokens），
+# 可用環境變數 PROMPT_CACHE_MIN_TOKENS 調整
+CACHE_MIN_TOKENS = int(os.environ.get("PROMPT_CACHE_MIN_TOKENS", "32768"))
+
+# 中日韓文字大致一字一個 token，其餘文字約四個字元一個 token
+CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u4dbf\u4e00-\u9fff\uff00-\uffef]")
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗估文字的 token 數，只用於比較提示詞長度，不需呼叫 API。
+    """
+    cjk = len(CJK_PATTERN.findall(text))
+    other = len(text) - cjk
+    return cjk + (other + 3) // 4
+
+def encode_rows(rows: list, columns: list) -> str:
+    """
+    將多筆資料編成精簡的 Tab 分隔表格：第一行為欄位名稱，其後每行一筆。
+    相較於 Python dict 清單或 CSV，不重複欄位名稱也不需要引號跳脫。
+    """
+    def clean(value):
+        if isinstance(value, (list, tuple)):
+            value = "；".join(str(v) for v in value)
+        return str(value).replace("\t", " ").replace("\r", " ").replace("\n", " ").strip()
+
+    lines = ["\t".join(columns)]
+    for row in rows:
+        lines.append("\t".join(clean(row.get(col, "")) for col in columns))
+    return "\n".join(lines)
+
+def report_savings(label: str, legacy_prompt: str, static_prefix: str, payload: str) -> int:
+    """
+    印出單次請求的提示詞 token 估計：
+      - 原始做法每次送出的完整提示；
+      - 新做法的靜態前綴（系統指令，可被快取重用）與每次變動的內容。
+    靜態前綴達到 CACHE_MIN_TOKENS 時，另外列出前綴命中快取時的節省量。
+    回傳相較原始做法每次請求節省的 token 數（不含快取效益）。
+    """
+    legacy_tokens = estimate_tokens(legacy_prompt)
+    prefix_tokens = estimate_tokens(static_prefix)
+    payload_tokens = estimate_tokens(payload)
+    saved = legacy_tokens - prefix_tokens - payload_tokens
+    message = (
+        f"[{label}] 提示詞 token 估計：原始 {legacy_tokens} → "
+        f"靜態前綴 {prefix_tokens} + 變動內容 {payload_tokens}，節省 {saved}"
+    )
+    if prefix_tokens >= CACHE_MIN_TOKENS:
+        message += f"（前綴命中快取時節省 {legacy_tokens - payload_tokens}）"
+    print(message)
+    return saved
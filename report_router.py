@@ -0,0 +1,188 @@
+import re
+import ast
+import pandas as pd
+from prompt_builder import encode_rows, report_savings
+from tracing import span
+
+try:
+    import pyarrow.parquet as pq
+except ImportError:  # 讀取 Parquet 為選用功能
+    pq = None
+
+# HW4 與 HW5 共用的報表設定與工具
+
+# 報表分析規則，與使用者指令一起放在系統指令中，各區塊請求共用同一段前綴
+REPORT_RULES = (
+    "你會收到 CSV 資料的一個區塊，以 Tab 分隔的表格呈現，第一行為欄位名稱。\n"
+    "請根據以下規則進行分析並產出報表（以 Markdown 表格格式輸出）：\n"
+    "1. 針對每個知識名詞，檢查其定義、延伸建議、實際應用、外部資源和觀念題目是否完整。\n"
+    "2. 如果任何欄位缺失或不完整，提供補充內容（例如詳細的定義、具體的應用案例等）。\n"
+    "3. 確保輸出為 Markdown 表格，包含所有原始欄位，並在適當欄位中新增補充內容。\n"
+    "4. 補充內容應清晰、具體，並與現有資料一致。\n"
+)
+
+# 模型分級：每個區塊先交給便宜、低延遲的模型，逐列驗證後只有未通過的知識名詞才升級
+REPORT_MODEL_TIERS = ["gemini-1.5-flash-8b", "gemini-1.5-flash"]
+
+# DRai.py 分片輸出的內部欄位，讀取 Parquet 時不載入
+INTERNAL_COLUMNS = ["_row_order"]
+
+# 報表中每筆知識名詞必須完整的欄位（與 DRai.py 的 ITEMS 相同）
+REPORT_ITEMS = ["定義與解釋", "延伸建議", "實際應用", "外部資源", "觀念題目"]
+QUESTION_SPLIT = re.compile(r"[；;\n]|<br\s*/?>")
+# 「1.」「Q2)」需位於開頭或空白後；括號編號「(1)」「（2）」可緊接在前一題的問號後
+QUESTION_NUMBER = re.compile(r"(?:^|\s)Q?\d+[.、)）]|[(（]Q?\d{1,2}[)）]")
+
+def load_table(path: str) -> pd.DataFrame:
+    """
+    讀取 CSV 或 Parquet 檔案，返回 pandas DataFrame。
+    Parquet 以欄位投影與記憶體映射載入，觀念題目清單轉為文字。
+    """
+    if not path.endswith(".parquet"):
+        return pd.read_csv(path)
+    if pq is None:
+        raise ValueError("讀取 Parquet 需要安裝 pyarrow")
+    available = pq.read_schema(path, memory_map=True).names
+    columns = [c for c in available if c not in INTERNAL_COLUMNS]
+    df = pq.read_table(path, columns=columns, memory_map=True).to_pandas()
+    if "觀念題目" in df.columns:
+        df["觀念題目"] = df["觀念題目"].map(lambda q: "；".join(q) if q is not None else "")
+    return df
+
+def find_term_column(columns) -> str:
+    """找出知識名詞欄位（knowledge_term 或含「知識名詞」的欄位），找不到時回傳 None"""
+    for col in columns:
+        if col.strip().lower() == "knowledge_term" or "知識名詞" in col:
+            return col
+    return None
+
+def normalize_term(term) -> str:
+    return str(term).strip().strip("*").strip().casefold()
+
+def count_questions(cell) -> int:
+    """
+    計算觀念題目欄位中的題數：
+    支援 Python 清單字串、以分號／換行／<br> 分隔，或在同一格以「1. 2. 3.」或「(1) (2) (3)」編號列出。
+    """
+    text = str(cell).strip()
+    if text.startswith("["):
+        try:
+            value = ast.literal_eval(text)
+            if isinstance(value, (list, tuple)):
+                return len([q for q in value if str(q).strip()])
+        except (ValueError, SyntaxError):
+            pass
+    parts = [p for p in QUESTION_SPLIT.split(text) if p.strip()]
+    if len(parts) <= 1:
+        numbered = QUESTION_NUMBER.findall(text)
+        if numbered:
+            return len(numbered)
+    return len(parts)
+
+def validate_report_row(row: dict) -> bool:
+    """檢查單筆報表列：所有項目欄位皆存在且非空白，且觀念題目為 3-5 題"""
+    for item in REPORT_ITEMS:
+        value = str(row.get(item, "")).strip()
+        if not value or value.lower() in ("nan", "none"):
+            return False
+    return 3 <= count_questions(row["觀念題目"]) <= 5
+
+def match_rows(terms: list, table, count: int) -> list:
+    """
+    將模型輸出的表格列對應回區塊中的資料列。
+    兩邊都有知識名詞欄位時依知識名詞對應，否則依列順序對應；對應不到的為 None。
+    """
+    records = table.to_dict(orient="records")
+    term_col = find_term_column(table.columns)
+    if term_col is not None and terms is not None:
+        by_term = {normalize_term(r[term_col]): r for r in records}
+        return [by_term.get(normalize_term(t)) for t in terms]
+    return [records[i] if i < len(records) else None for i in range(count)]
+
+def render_markdown_table(headers: list, rows: list) -> str:
+    def clean(value):
+        return str(value).replace("|", "／").replace("\n", " ").strip()
+
+    lines = ["| " + " | ".join(headers) + " |", "|" + "|".join("---" for _ in headers) + "|"]
+    for row in rows:
+        lines.append("| " + " | ".join(clean(row.get(h, "")) for h in headers) + " |")
+    return "\n".join(lines)
+
+def block_header(block) -> str:
+    """列號取自 block.index，因此子區塊仍標示原始位置"""
+    positions = [int(i) + 1 for i in block.index]
+    if positions == list(range(positions[0], positions[-1] + 1)):
+        return f"以下是 CSV 資料第 {positions[0]} 到 {positions[-1]} 筆：\n"
+    return f"以下是 CSV 資料第 {'、'.join(str(p) for p in positions)} 筆：\n"
+
+def build_block_prompt(block) -> str:
+    """將資料區塊（或升級時未通過驗證的部分資料列）編成提示"""
+    return block_header(block) + encode_rows(block.to_dict(orient="records"), list(block.columns))
+
+def build_legacy_block_prompt(block, user_prompt: str) -> str:
+    """重建舊版提示（每個區塊重送 CSV 與完整規則），僅用於估算節省的 token 數"""
+    return block_header(block) + block.to_csv(index=False) + "\n\n" + REPORT_RULES.split("\n", 1)[1] + user_prompt
+
+def route_block_report(models: list, block, parse_table, user_prompt: str = "", label: str = "報表") -> str:
+    """
+    模型分級路由：整個區塊先交給第一級（最便宜）模型，
+    逐列驗證後只把未通過的知識名詞送往下一級模型，再把結果拼回同一張 Markdown 表格。
+      - models：[(模型名稱, 模型)]，由便宜到強排列，系統指令為 REPORT_RULES + user_prompt；
+      - parse_table(text)：將模型回覆解析成 DataFrame，失敗時回傳 None；
+      - label：印出每次請求提示詞 token 估計時的標籤。
+    所有等級都無法產生可解析的表格時，回傳最後一次的原始回覆；完全沒有回覆則拋出最後一個錯誤。
+    """
+    system_instruction = REPORT_RULES + user_prompt
+    block_term_col = find_term_column(block.columns)
+    results = [None] * len(block)
+    pending = list(range(len(block)))
+    headers = []
+    last_error = None
+    last_response = None
+
+    for tier, (model_name, model) in enumerate(models):
+        if not pending:
+            break
+        if tier > 0:
+            print(f"{len(pending)} 筆結果未通過驗證，升級至 {model_name} 重新處理")
+        sub_block = block.iloc[pending]
+        with span("build_prompt", model=model_name, rows=len(sub_block)):
+            prompt = build_block_prompt(sub_block)
+            report_savings(
+                f"{label} {model_name}", build_legacy_block_prompt(sub_block, user_prompt), system_instruction, prompt
+            )
+        try:
+            with span("generate_content", model=model_name, rows=len(sub_block)):
+                response = model.generate_content(prompt).text.strip()
+        except Exception as e:
+            last_error = e
+            print(f"{model_name} 生成失敗：{str(e)}")
+            continue
+        last_response = response
+        with span("parse_markdown_table", model=model_name):
+            table = parse_table(response)
+        if table is None:
+            print(f"{model_name} 的輸出無法解析成 Markdown 表格")
+            continue
+        headers.extend(h for h in table.columns if h not in headers)
+
+        terms = sub_block[block_term_col].tolist() if block_term_col is not None else None
+        still_pending = []
+        for pos, row in zip(pending, match_rows(terms, table, len(sub_block))):
+            # 較強模型的結果即使未通過驗證也採用，並留待下一級處理
+            if row is not None:
+                results[pos] = row
+            if row is None or not validate_report_row(row):
+                still_pending.append(pos)
+        pending = still_pending
+
+    if not headers:
+        if last_response is None:
+            raise last_error
+        return last_response
+    if pending:
+        print(f"{len(pending)} 筆結果在所有模型等級皆未通過驗證")
+    # 所有模型都沒有輸出的資料列保留原始內容，避免從報表中消失
+    block_records = block.to_dict(orient="records")
+    rows = [row if row is not None else block_records[pos] for pos, row in enumerate(results)]
+    return render_markdown_table(headers, rows)
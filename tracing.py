@@ -0,0 +1,206 @@
+import os
+import sys
+import json
+import time
+import itertools
+import threading
+from contextvars import ContextVar
+from contextlib import contextmanager
+from datetime import datetime
+
+# 設定環境變數 PIPELINE_TRACE=1 即可啟用追蹤；PIPELINE_TRACE_INTERVAL 為取樣間隔（毫秒）
+TRACE_ENV = "PIPELINE_TRACE"
+INTERVAL_ENV = "PIPELINE_TRACE_INTERVAL"
+
+class Tracer:
+    """
+    收集單次執行的追蹤資料：
+      - span：以 "X" 事件記錄各階段的開始時間與耗時，寫入 Chrome trace 檔（chrome://tracing、Perfetto 可開啟）；
+      - 取樣：背景執行緒定期擷取執行此次 run 的執行緒呼叫堆疊，寫入 Chrome trace 的 stackFrames 與 samples
+        （僅 chrome://tracing 讀取），並另存成 speedscope 的 sampled profile（<trace>.speedscope.json）。
+    """
+
+    def __init__(self, path: str, sample_interval: float = 0.005):
+        self.path = path
+        self.speedscope_path = os.path.splitext(path)[0] + ".speedscope.json"
+        self.sample_interval = sample_interval
+        self.pid = os.getpid()
+        # 只取樣開啟此追蹤的執行緒，Flask 同時處理的其他請求不會混入
+        self.owner_tid = threading.get_ident()
+        self.events = []
+        self.stack_frames = {}
+        self.samples = []
+        self._frame_ids = {}
+        self._lock = threading.Lock()
+        self._origin = time.perf_counter()
+        self._stop = threading.Event()
+        self._sampler = threading.Thread(target=self._sample_loop, name="trace-sampler", daemon=True)
+
+    def now_us(self) -> float:
+        return (time.perf_counter() - self._origin) * 1e6
+
+    def start(self):
+        self._sampler.start()
+
+    def add_span(self, name: str, start_us: float, end_us: float, args: dict):
+        event = {
+            "name": name,
+            "cat": "stage",
+            "ph": "X",
+            "ts": start_us,
+            "dur": end_us - start_us,
+            "pid": self.pid,
+            "tid": threading.get_ident(),
+            "args": {k: str(v) for k, v in args.items()},
+        }
+        with self._lock:
+            self.events.append(event)
+
+    def _frame_id(self, name: str, parent: str) -> str:
+        key = (name, parent)
+        frame_id = self._frame_ids.get(key)
+        if frame_id is None:
+            frame_id = str(len(self._frame_ids) + 1)
+            self._frame_ids[key] = frame_id
+            frame = {"category": "python", "name": name}
+            if parent is not None:
+                frame["parent"] = parent
+            self.stack_frames[frame_id] = frame
+        return frame_id
+
+    def _sample_loop(self):
+        sampler_id = threading.get_ident()
+        while not self._stop.wait(self.sample_interval):
+            ts = self.now_us()
+            for tid, frame in sys._current_frames().items():
+                if tid == sampler_id or tid != self.owner_tid:
+                    continue
+                stack = []
+                while frame is not None:
+                    code = frame.f_code
+                    stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+                    frame = frame.f_back
+                with self._lock:
+                    parent = None
+                    for name in reversed(stack):
+                        parent = self._frame_id(name, parent)
+                    self.samples.append({
+                        "cpu": 0, "tid": tid, "ts": ts, "name": "sample", "sf": parent, "weight": 1
+                    })
+
+    def _speedscope_profile(self) -> dict:
+        """把取樣轉成 speedscope 檔案格式：共用 frames 表，每筆取樣為由外到內的 frame 索引清單"""
+        frames = []
+        frame_index = {}
+        stacks = []
+        weights = []
+        for i, sample in enumerate(self.samples):
+            stack = []
+            frame_id = sample["sf"]
+            while frame_id is not None:
+                frame = self.stack_frames[frame_id]
+                index = frame_index.get(frame["name"])
+                if index is None:
+                    index = frame_index[frame["name"]] = len(frames)
+                    frames.append({"name": frame["name"]})
+                stack.append(index)
+                frame_id = frame.get("parent")
+            stacks.append(stack[::-1])
+            # 每筆取樣代表到前一筆取樣之間的時間
+            previous_ts = self.samples[i - 1]["ts"] if i > 0 else sample["ts"] - self.sample_interval * 1e6
+            weights.append(sample["ts"] - previous_ts)
+        end_value = self.samples[-1]["ts"] if self.samples else 0
+        return {
+            "$schema": "https://www.speedscope.app/file-format-schema.json",
+            "shared": {"frames": frames},
+            "profiles": [{
+                "type": "sampled",
+                "name": os.path.basename(self.path),
+                "unit": "microseconds",
+                "startValue": end_value - sum(weights),
+                "endValue": end_value,
+                "samples": stacks,
+                "weights": weights,
+            }],
+            "name": os.path.basename(self.path),
+            "exporter": "tracing.py",
+        }
+
+    def stop(self):
+        self._stop.set()
+        self._sampler.join()
+        with self._lock:
+            data = {
+                "traceEvents": sorted(self.events, key=lambda e: e["ts"]),
+                "stackFrames": self.stack_frames,
+                "samples": self.samples,
+                "displayTimeUnit": "ms",
+            }
+            profile = self._speedscope_profile()
+        with open(self.path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        with open(self.speedscope_path, "w", encoding="utf-8") as f:
+            json.dump(profile, f, ensure_ascii=False)
+
+# 目前生效的追蹤器存放在 ContextVar 中：每個執行緒（如 Flask 的各個請求）各自獨立，
+# 同一執行緒內的巢狀 trace_run 則共用外層的追蹤器
+_current_tracer = ContextVar("current_tracer", default=None)
+_run_ids = itertools.count(1)
+
+def _reset_after_fork():
+    # fork 出的子行程（例如 DRai 的分片 worker）不沿用父行程的追蹤器，需自行建立追蹤檔
+    _current_tracer.set(None)
+
+if hasattr(os, "register_at_fork"):
+    os.register_at_fork(after_in_child=_reset_after_fork)
+
+def trace_enabled_by_env() -> bool:
+    return os.environ.get(TRACE_ENV, "").strip().lower() in ("1", "true", "yes", "on")
+
+@contextmanager
+def trace_run(label: str, enabled: bool = None, output_dir: str = "."):
+    """
+    在此區塊內啟用追蹤，結束時寫出 trace_<label>_<時間>_<pid>_<序號>.json
+    與同名的 .speedscope.json 取樣檔。
+    enabled 未指定時依環境變數 PIPELINE_TRACE 決定；巢狀呼叫時共用外層的追蹤檔，
+    不同執行緒同時呼叫則各自輸出。
+    """
+    if enabled is None:
+        enabled = trace_enabled_by_env()
+    if not enabled:
+        yield None
+        return
+
+    current = _current_tracer.get()
+    if current is not None:
+        with span(label):
+            yield current
+        return
+
+    interval_ms = float(os.environ.get(INTERVAL_ENV, "5"))
+    filename = (
+        f"trace_{label}_{datetime.now().strftime('%Y%m%d_%H%M%S')}_{os.getpid()}_{next(_run_ids)}.json"
+    )
+    tracer = Tracer(os.path.join(output_dir, filename), interval_ms / 1000)
+    token = _current_tracer.set(tracer)
+    tracer.start()
+    try:
+        with span(label):
+            yield tracer
+    finally:
+        _current_tracer.reset(token)
+        tracer.stop()
+        print(f"追蹤檔已寫入：{tracer.path}（取樣：{tracer.speedscope_path}）")
+
+@contextmanager
+def span(name: str, **args):
+    """記錄一個階段的耗時；未啟用追蹤時不做任何事"""
+    tracer = _current_tracer.get()
+    if tracer is None:
+        yield
+        return
+    start_us = tracer.now_us()
+    try:
+        yield
+    finally:
+        tracer.add_span(name, start_us, tracer.now_us(), args)